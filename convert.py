@@ -47,8 +47,15 @@ How To:  First, you need to dump the layout from Cadence. From the ICFB window,
         as PDF/PNG without looking at the entire document.
 """
 
+import os
 import sys
-import operator
+import re
+import mmap
+import itertools
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict, Counter
 
 """
 These are the layer color definitions. For each layer, you should define a 
@@ -103,6 +110,12 @@ layer_colors[148] =  ("01fe00",   "0.0",        "01fe00"      ) # CTMDMY
 layer_colors[149] =  ("01fe00",   "0.0",        "01fe00"      ) # PO Pin
 layer_colors[150] =  ("bf4026",   "0.0",        "bf4026"      ) # CBM
 
+# The SVG style string for each layer is built once here, rather than for every
+# polygon. Polygons on a layer without colors are drawn with DEFAULT_STYLE.
+STYLE_TEMPLATE = "fill:#%s;fill-opacity:%s;stroke:#%s;stroke-width:2;stroke-linecap:round;stroke-linejoin:round;stroke-miterlimit:4;stroke-dasharray:none;stroke-dashoffset:0;stroke-opacity:1"
+layer_styles = {layer: STYLE_TEMPLATE % colors for layer, colors in layer_colors.items()}
+DEFAULT_STYLE = STYLE_TEMPLATE % ("000000", "0.8", "000000")
+
 # We keep track of all the undefined_layers so we can tell the user at the end of execution.
 undefined_layers = set()
 
@@ -110,103 +123,149 @@ undefined_layers = set()
 Plain SVG documents do not include any layering capabilities, as far as I know.
 Based on some experiments, it seemed that items are rendered from the top down,
 so putting the lower layers first seems to produce a more accurate drawing.
-We first put all our polygons into this list, as a tuple of (layer, string), so
-that we can sort the polygons by layer, and write them from lowest layer to
-highest layer before writing them to the SVG file.
+We first put each polygon's string into the bucket for its layer, so that we
+can write the buckets from lowest layer to highest layer when writing the SVG
+file, without having to sort every polygon by layer.
+"""
+layer_buckets = defaultdict(list)
+
 """
-to_write = []
+Layouts tend to place the same cell many times (think of a row of standard
+cells). Rather than writing out the polygons of such a cell again for every
+placement, a cell placed at least SHARED_CELL_MIN_PLACEMENTS times has its
+polygons written once, in cell-local coordinates, into a group inside <defs>.
+Each placement is then just a <use> of that group with a transform. There is
+one such group per layer of the cell, so that every <use> can still go into the
+bucket of its layer and the layering stays the same. The groups are collected
+in symbol_buckets, by SVG id.
+"""
+SHARED_CELL_MIN_PLACEMENTS = 2
+symbol_buckets = {}
 
-# Each object needs to have a unique id, so we keep this global variable.
-object_id = 0
+# Each object needs to have a unique id, so we keep this global counter.
+next_object_id = itertools.count().__next__
 
 """
-There are two types of objects: Polygons, and Containers.
-They both inherit from Cell, which defines the print_me function.
+There are three types of objects: Polygons, Rectangles, and Containers.
+They all inherit from Cell. All of them know how to print themselves, while the
+cell hierarchy of Containers is walked by flatten (see below).
+Large layouts have millions of these objects, so they all use __slots__ to save
+the memory of a per-object __dict__.
 """
 class Cell:
-    """ this function prints the cell and all children """
-    def print_me(self, x, y, angle, mirror):
-        pass
+    __slots__ = ()
 
 """
 The Container class stores a list of its children, along with their relative
-position, rotation, and mirroring property. When a Container is asked to print
-itself at a certain position, rotation, and mirroring, it simply computes each
-child's updated position, and asks the child to print itself. Notice that the 
+position, rotation, and mirroring property. When a Container is placed at a
+certain position, rotation, and mirroring, flatten simply computes each child's
+updated position and places the child there in turn. Notice that the 
 angle for each child is computed as the Container's rotation plus the child's
 relative rotation, mod 360 degrees. The mirroring property is similarly defined
 but since it is a boolean flag, the XOR (^) is used instead: basically, the 
 child should be mirrored only if either the parent is mirrored, or the child is
 mirrored, but not if both parent and child are mirrored.
+When printed, a Container only prints the shapes (Polygons and Rectangles)
+directly inside it; the child Containers are placed and printed by flatten.
+Shapes are always added with no offset, rotation or mirroring of their own, so
+they take the Container's placement as is.
 """
 class Container(Cell):
+    __slots__ = ("children", "id", "symbols")
+
     def __init__(self):
         self.children = []
+        # self.id is used for the SVG ids of this cell's symbols, if it gets any
+        self.id = "cell" + str(next_object_id())
+        # the list of (layer, symbol id) once make_symbols has been called
+        self.symbols = None
 
     def add(self, obj, x, y, angle, mirror):
         """ adds the object as a child with relative offset (x,y) """
          # we make a tuple to put in the list
         self.children.append( (obj, x, y, angle, mirror) )
 
-    def print_me(self, x, y, angle, mirror):
-        # go through each child component and have them print themselves:
+    def print_me(self, x, y, angle, mirror, first=0, last=None):
+        """ Prints the shapes of this container, offset by x,y """
+        # first and last let a big container be printed in several parts
+        for c in self.children[first:last]:
+            p = c[0]
+            if not isinstance(p, Container):
+                layer_buckets[p.layer].append(p.print_me(x, y, angle, mirror))
+
+    def make_symbols(self):
+        """ Prints the shapes of this container once, into symbol_buckets """
+        by_layer = defaultdict(list)
         for c in self.children:
-            # first, compute the child's new origin
-            c_x, c_y = rot_mirror_and_offset(c[1], c[2], angle, mirror, x, y)
-            c[0].print_me(c_x, c_y, (c[3] + angle) % 360, c[4] ^ mirror)
+            p = c[0]
+            if not isinstance(p, Container):
+                by_layer[p.layer].append(p.print_me(0, 0, 0, 0))
+        self.symbols = []
+        for layer, bucket in by_layer.items():
+            symbol_id = self.id + "_" + str(layer)
+            symbol_buckets[symbol_id] = bucket
+            self.symbols.append( (layer, symbol_id) )
+
+    def print_use(self, x, y, angle, mirror):
+        """ Prints a reference to this container's symbols, offset by x,y """
+        if self.symbols is None:
+            self.make_symbols()
+        transform = svg_transform(x, y, angle, mirror)
+        for layer, symbol_id in self.symbols:
+            layer_buckets[layer].append('    <use xlink:href="#%s" transform="%s" />\n' % (symbol_id, transform))
 
 """
-A Polygon is the base geometric object. Rectangles in the ASCII dump stream are
-converted to 5-point polygons for simplicity. Polygon objects keep their list
-of points (scaled down by dividing by 10), as well as their layer, which is
-used to find the color. This class uses rot_mirror_and_offset to compute the
-new locations of its points based on the information the parent sends in.
+A Polygon is the base geometric object. Polygon objects keep their list
+of points (as integers in the dump's units, see format_coord), as well as their
+layer, which is used to find the color. This class uses transform_points to
+compute the new locations of all its points at once based on the information
+the parent sends in. Printing a Polygon returns its SVG path, ready to be put
+in a bucket.
 """
 class Polygon(Cell):
     """ this object reprsents a polygon """
-    
+    __slots__ = ("points", "layer", "id")
+
     def __init__(self, points, layer):
-        global object_id, layer_colors
-        self.points = []
-        for p in points:
-            self.points.append( (p[0] / 10, p[1] / 10) )
+        self.points = points
         self.layer = layer
         # self.id is used as the unique SVG id
-        self.id = "path" + str(object_id)
-        object_id += 1
+        self.id = "path" + str(next_object_id())
 
     def print_me(self, x, y, angle, mirror):
-        """ Prints this polygon, offset by x,y """
-        if self.layer in layer_colors:
-            color_info = layer_colors.get(self.layer)
-        else:
-            # the layer does not exist
-            print("WARNING!")
-            print("  This input file uses a layer (" + str(self.layer) + ") that is not defined!")
-            print("  The objects in this layer will be drawn as black boxes.")
-            print("  To fix this, simply add a new line to the source file for the new layer.")
-            print("  Please look in the source around line 60.")
-            undefined_layers.add(self.layer)
-            color_info = ("000000", "0.8", "000000")
-        style = "fill:#" + color_info[0] + ";fill-opacity:" + color_info[1] + ";stroke:#" + color_info[2] + ";stroke-width:2;stroke-linecap:round;stroke-linejoin:round;stroke-miterlimit:4;stroke-dasharray:none;stroke-dashoffset:0;stroke-opacity:1"
-        
-        path = "M"
-        first = True
-        for p in self.points:
-            if first == False:
-                path += " L"
-            
-            my_x, my_y = rot_mirror_and_offset(p[0], p[1], angle, mirror, x, y)
-        
-            # because inkscape uses graphics coordinates:
-            my_y = -my_y
-        
-            path += " " + str(my_x) + "," + str(my_y);
-            first = False
-            
-        path += " z"
+        """ Returns this polygon as an SVG path, offset by x,y """
+        # because inkscape uses graphics coordinates, we flip y as we go
+        points = transform_points(self.points, angle, mirror, x, y)
+        fmt = format_coord # a local lookup is cheaper in the loop below
+        path = " L ".join([ fmt(px) + "," + fmt(-py) for px, py in points ])
 
-        to_write.append( (self.layer, '    <path\n       d="' + path + '"\n       id="' + self.id + '"\n       style="' + style + '" />\n') )
+        # the style is set once for the whole layer, see dump_layer_buckets_to_file
+        return '    <path d="M %s z" id="%s" />\n' % (path, self.id)
+
+"""
+Rectangles in the ASCII dump stream are kept as just two opposite corners, and
+written out as SVG <rect> elements, which are a lot smaller than the equivalent
+5-point path. Since we only ever rotate by multiples of 90 degrees, a rotated
+or mirrored rectangle is still axis-aligned, so we transform the two corners
+and take the new rectangle from the smallest and largest x and y.
+"""
+class Rectangle(Cell):
+    """ this object represents an axis-aligned rectangle """
+    __slots__ = ("points", "layer", "id")
+
+    def __init__(self, x1, y1, x2, y2, layer):
+        self.points = [ (x1, y1), (x2, y2) ]
+        self.layer = layer
+        # self.id is used as the unique SVG id
+        self.id = "rect" + str(next_object_id())
+
+    def print_me(self, x, y, angle, mirror):
+        """ Returns this rectangle as an SVG rect, offset by x,y """
+        (x1, y1), (x2, y2) = transform_points(self.points, angle, mirror, x, y)
+        # because inkscape uses graphics coordinates, the top edge is the larger y
+        return '    <rect x="%s" y="%s" width="%s" height="%s" id="%s" />\n' % \
+               (format_coord(min(x1, x2)), format_coord(-max(y1, y2)),
+                format_coord(abs(x2 - x1)), format_coord(abs(y2 - y1)), self.id)
 
 """
 Takes the original object's coordinates (obj_x and obj_y), applies a rotation
@@ -237,17 +296,167 @@ def rot_mirror_and_offset(obj_x, obj_y, angle, mirror, off_x, off_y):
     
     return my_x, my_y
     
+"""
+The same transformation as rot_mirror_and_offset, but applied to a whole list
+of points at once. There are only eight combinations of rotation and mirroring,
+so each one gets its own specialized comprehension in TRANSFORMS, indexed by
+angle / 90, plus 4 if mirrored. Picking the right one once per call leaves the
+per-point work as plain additions and negations, with no branching on the angle
+and no multiplying by 0 or 1.
+"""
+TRANSFORMS = (
+    lambda points, off_x, off_y: [ (off_x + px, off_y + py) for px, py in points ], # 0
+    lambda points, off_x, off_y: [ (off_x - py, off_y + px) for px, py in points ], # 90
+    lambda points, off_x, off_y: [ (off_x - px, off_y - py) for px, py in points ], # 180
+    lambda points, off_x, off_y: [ (off_x + py, off_y - px) for px, py in points ], # 270
+    lambda points, off_x, off_y: [ (off_x + px, off_y - py) for px, py in points ], # 0, mirrored
+    lambda points, off_x, off_y: [ (off_x - py, off_y - px) for px, py in points ], # 90, mirrored
+    lambda points, off_x, off_y: [ (off_x - px, off_y + py) for px, py in points ], # 180, mirrored
+    lambda points, off_x, off_y: [ (off_x + py, off_y + px) for px, py in points ], # 270, mirrored
+)
+
+def transform_points(points, angle, mirror, off_x, off_y):
+    return TRANSFORMS[int(angle) // 90 + 4 * mirror](points, off_x, off_y)
+
+"""
+All coordinates are kept as integers in the units of the stream dump, which are
+tenths of the units we write to the SVG. Doing the transformations on integers
+keeps them exact, and we only scale down by 10 when writing a coordinate out.
+Whole numbers are written without a trailing ".0" to keep the file small.
+Turning numbers into text is the most expensive part of writing the SVG, and
+layouts reuse the same coordinates over and over (grids, rows of cells), so
+the strings are cached.
+"""
+@functools.lru_cache(maxsize=1<<16)
+def format_coord(v):
+    if v % 10 == 0:
+        return str(v // 10)
+    return "%.1f" % (v / 10)
+
+"""
+The SVG transform for a <use> of a symbol placed like a Container at x,y. The
+symbols are already drawn in graphics coordinates (y flipped), so the rotation
+goes the other way, and we flip y of the offset as well. The rotation is
+applied first and the mirroring second, just like in transform_points.
+"""
+def svg_transform(x, y, angle, mirror):
+    transform = "translate(" + format_coord(x) + "," + format_coord(-y) + ")"
+    if mirror:
+        transform += " scale(1,-1)"
+    if angle:
+        transform += " rotate(" + str(-int(angle)) + ")"
+    return transform
+
+"""
+Walks the cell hierarchy below top_cell once, without recursion, and returns a
+flat table of every Container placement in the layout. The table is kept as
+parallel lists (container, x, y, angle, mirror), one entry per placement, in
+the same order a depth-first walk of the children would visit them. Containers
+are kept on an explicit stack; we push children in reverse so that they come
+off the stack in their original order.
+"""
+def flatten(top_cell):
+    containers, xs, ys, angles, mirrors = [], [], [], [], []
+    stack = [ (top_cell, 0, 0, 0, 0) ]
+    while stack:
+        obj, x, y, angle, mirror = stack.pop()
+        containers.append(obj)
+        xs.append(x)
+        ys.append(y)
+        angles.append(angle)
+        mirrors.append(mirror)
+        for c in reversed(obj.children):
+            if not isinstance(c[0], Container):
+                continue # shapes are printed by the Container itself
+            # compute the child's new origin, angle and mirroring
+            c_x, c_y = rot_mirror_and_offset(c[1], c[2], angle, mirror, x, y)
+            stack.append( (c[0], c_x, c_y, (c[3] + angle) % 360, c[4] ^ mirror) )
+    return containers, xs, ys, angles, mirrors
+
+"""
+Printing the placements is the bulk of the work for big layouts, and every
+placement can be printed independently of the others, so we spread the work
+over several processes. make_jobs splits the placement table from flatten into
+jobs of about JOB_SIZE shapes each; a big container (like a flat top cell) is
+split over several jobs by child index, as (placement, shared, first, last)
+parts. Each job returns the joined SVG text it printed for each layer, and we
+add those to the layer buckets in job order, so the output is exactly what
+printing everything in this process would give. Symbols of shared cells are
+made up front by make_jobs, as workers can't add to symbol_buckets. make_jobs
+also counts the shapes and cell references written.
+The workers are forked, so instead of pickling the placement table (and every
+cell in it) along with each job, we put it in worker_placements right before
+starting the pool, and each worker reads its own forked copy from there.
+"""
+JOB_SIZE = 10000
+worker_placements = None
+
+def make_jobs(containers, placement_counts):
+    jobs, job, size = [], [], 0
+    numShapes, numUses = 0, 0
+    for i, c in enumerate(containers):
+        if placement_counts[c] >= SHARED_CELL_MIN_PLACEMENTS:
+            if c.symbols is None:
+                c.make_symbols()
+                numShapes += sum([ len(symbol_buckets[symbol_id]) for layer, symbol_id in c.symbols ])
+            numUses += len(c.symbols)
+            job.append( (i, True, 0, None) )
+            size += len(c.symbols)
+        else:
+            numShapes += sum([ 1 for child in c.children if not isinstance(child[0], Container) ])
+            for first in range(0, len(c.children), JOB_SIZE):
+                job.append( (i, False, first, first + JOB_SIZE) )
+                size += min(JOB_SIZE, len(c.children) - first)
+                if size >= JOB_SIZE:
+                    jobs.append(job)
+                    job, size = [], 0
+        if size >= JOB_SIZE:
+            jobs.append(job)
+            job, size = [], 0
+    if job:
+        jobs.append(job)
+    return jobs, numShapes, numUses
+
+def print_placement(placements, i, shared, first, last):
+    containers, xs, ys, angles, mirrors = placements
+    if shared:
+        containers[i].print_use(xs[i], ys[i], angles[i], mirrors[i])
+    else:
+        containers[i].print_me(xs[i], ys[i], angles[i], mirrors[i], first, last)
+
+def print_job(job):
+    # this runs in a worker, which reuses its own copy of layer_buckets per job
+    layer_buckets.clear()
+    for part in job:
+        print_placement(worker_placements, *part)
+    return { layer: "".join(bucket) for layer, bucket in layer_buckets.items() }
+
 """
 Once we have read in the entire file, and have populated our data structures
-with all the geometry data, we sort the "to_write" list to produce the proper
-layering in the SVG (see explanation above), and write each line to the file.
+with all the geometry data, we write out the layer buckets in order of layer
+number to produce the proper layering in the SVG (see explanation above). Each
+layer is wrapped in a <g> group that carries the style for all of its paths.
+The symbols of shared cells go first, into <defs>. The contents of each group
+are put together with a single join and encoded in one go; the opening and
+closing tags are written separately, so we never hold more than the joined
+text and its encoded copy of a bucket at once.
 """
-def dump_to_write_to_file(output_file):
-    global to_write
-    # first we sort the items:
-    to_write = sorted(to_write, key=operator.itemgetter(0))
-    for x in to_write:
-        output_file.write(x[1] + "\n")
+def dump_layer_buckets_to_file(output_file):
+    output_file.write(b'  <defs\n     id="defs4">\n')
+    for symbol_id, bucket in symbol_buckets.items():
+        output_file.write(('  <g id="%s">\n' % symbol_id).encode("ascii"))
+        output_file.write("".join(bucket).encode("ascii"))
+        output_file.write(b'  </g>\n')
+    output_file.write(b'  </defs>\n')
+    for layer in sorted(layer_buckets):
+        style = layer_styles.get(layer)
+        if style is None:
+            # the layer does not exist, we warn about it at the end
+            undefined_layers.add(layer)
+            style = DEFAULT_STYLE
+        output_file.write(('  <g style="%s">\n' % style).encode("ascii"))
+        output_file.write("".join(layer_buckets[layer]).encode("ascii"))
+        output_file.write(b'  </g>\n')
 
 """
 Produces a standard, plain vanilla SVG header. The width and height aren't
@@ -256,141 +465,139 @@ a lot of work, and you can use Inkscape to reset the bounding box to contain
 every object with a single button click.
 """
 def make_svg_header(output_file, width, height):
-    output_file.write("<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"no\"?>\n")
-    output_file.write("<!-- Created with Inkscape (http://www.inkscape.org/) -->\n")
-    output_file.write("<svg\n")
-    output_file.write("   xmlns:svg=\"http://www.w3.org/2000/svg\"\n")
-    output_file.write("   xmlns=\"http://www.w3.org/2000/svg\"\n")
-    output_file.write("   version=\"1.0\"\n")
-    output_file.write('   width="%d"\n' % width)
-    output_file.write('   height="%d"\n' % height)
-    output_file.write("   id=\"svg2\">\n")
-    output_file.write("  <defs\n")
-    output_file.write("     id=\"defs4\" />\n")
+    output_file.write(b"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"no\"?>\n"
+                      b"<!-- Created with Inkscape (http://www.inkscape.org/) -->\n"
+                      b"<svg\n"
+                      b"   xmlns:svg=\"http://www.w3.org/2000/svg\"\n"
+                      b"   xmlns=\"http://www.w3.org/2000/svg\"\n"
+                      b"   xmlns:xlink=\"http://www.w3.org/1999/xlink\"\n"
+                      b"   version=\"1.0\"\n"
+                      b'   width="%d"\n'
+                      b'   height="%d"\n'
+                      b"   id=\"svg2\">\n" % (width, height))
 
 # Close up the <svg> tag
 def make_svg_footer(output_file):
-    output_file.write("</svg>\n")
+    output_file.write(b"</svg>\n")
 
 # Begin main code
 if len(sys.argv) < 3:
     sys.exit("Usage: %s input_file output_file" % sys.argv[0])
     
-input_file = open(sys.argv[1], 'r')
-output_file = open(sys.argv[2], 'w')
+input_file = open(sys.argv[1], 'rb')
+# the SVG is written as bytes, through a large buffer to cut down on syscalls
+output_file = open(sys.argv[2], 'wb', buffering=1<<20)
 make_svg_header(output_file, 100, 100)
 
-cells = {} # this will store our cells, lookup by name
-
-# This variable stores the cell we are currently parsing
-# Newly parsed polygons will be added to this object
-currentCell = 0
-
-line = input_file.readline()
-while line != '':
-    if line.startswith("Cell Name"):
-        # defining a new cell type
-        things = line.split()
-        currentCell = Container()
-        name = things[3].strip(',')
-        cells[name] = currentCell
-        # Now, currentCell is the currently open cell,
-        # and any subsequently parsed pieces will be added to this cell.
-    elif line.startswith("Cell Instance"):
-        # instantiating an object
-        name = line.split()[6]
-        line = input_file.readline()
-        things = line.split()
-        coord = things[2].strip('()').split(",")
-        x = int(coord[0])/10
-        y = int(coord[1])/10
-        angle = float(things[5])
-        mirror = bool(int(things[8]))
-        c = cells[name]
-        currentCell.add(c, x, y, angle, mirror)
-    elif line.startswith("End Cell Definition"):
-        pass # nothing to do here
-    elif line.startswith("Rectangle"):
-        things = line.split()
-        layer = int(things[4])
-        coord = things[11].strip('()').split(",")
-        x1 = int(coord[0])
-        y1 = int(coord[1])
-        coord = things[12].strip('()').split(",")
-        x2 = int(coord[0])
-        y2 = int(coord[1])
-        # to save code, we just make this rectangle into a polygon
-        points = []
-        points.append( (x1, y1) )
-        points.append( (x1, y2) )
-        points.append( (x2, y2) )
-        points.append( (x2, y1) )
-        points.append( (x1, y1) )
-        p = Polygon(points, layer)
-        currentCell.add(p, 0, 0, 0, 0)
-        # the polygon is already handling it's own offset, so we leave x=0, y=0
-    elif line.startswith("Polygon"):
-        things = line.split()
-        layer = int(things[4])
-        numPoints = int(things[13])
-        points = []
-        numPointsLeft = numPoints
-        while True:
-            line = input_file.readline()
-            things = line.split()
-                
-            if numPointsLeft >= 4:
-                coord = things[0].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[1].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[2].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[3].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                numPointsLeft -= 4
-            elif numPointsLeft == 3:
-                coord = things[0].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[1].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[2].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                numPointsLeft -= 3
-            elif numPointsLeft == 2:
-                coord = things[0].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                coord = things[1].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                numPointsLeft -= 2
-            elif numPointsLeft == 1:
-                coord = things[0].strip('()').split(",")
-                points.append( (int(coord[0]), int(coord[1])) )
-                numPointsLeft -= 1
-
-            if numPointsLeft == 0:
-                break
-        
-        p = Polygon(points, layer)
-        currentCell.add(p, 0, 0, 0, 0)
-        # the polygon is already handling it's own offset, so we leave x=0, y=0
-    
-    line = input_file.readline()
+"""
+Rather than walking the dump line by line, we memory-map it and let the regex
+engine find the records we care about, working on the raw bytes so nothing has
+to be decoded or copied line by line. Each match of RECORD_RE is one
+record header. An instance also grabs its second line as "place", since that
+line holds the origin, angle and mirror fields. The field positions are the
+same ones the dump has always used, so we still split the matched text and
+index into the tokens.
+Polygon points follow their header, four to a line, so we skip ahead over the
+right number of lines and pull all the (x,y) pairs out of that block in one go.
+parse_dump returns the cells by name, and the last cell defined. It is a
+function so that everything the parse loop touches (the last match, shape and
+instanced cell) goes away when it returns, rather than living on as globals.
+"""
+RECORD_RE = re.compile(rb"^(?:(?P<cell>Cell Name.*)|(?P<inst>Cell Instance.*)\n(?P<place>.*)|(?P<rect>Rectangle.*)|(?P<poly>Polygon.*))", re.M)
+COORD_RE = re.compile(rb"\((-?\d+),(-?\d+)\)")
+
+def parse_dump(data):
+    cells = {} # this will store our cells, lookup by name
+
+    # This variable stores the cell we are currently parsing
+    # Newly parsed polygons will be added to this object
+    currentCell = 0
+
+    for m in RECORD_RE.finditer(data):
+        kind = m.lastgroup
+        things = m.group(kind).split()
+        if kind == "cell":
+            # defining a new cell type
+            currentCell = Container()
+            name = things[3].strip(b',').decode()
+            cells[name] = currentCell
+            # Now, currentCell is the currently open cell,
+            # and any subsequently parsed pieces will be added to this cell.
+        elif kind == "place":
+            # instantiating an object, the placement is on the line after the name
+            name = m.group("inst").split()[6].decode()
+            x, y = map(int, COORD_RE.match(things[2]).groups())
+            angle = float(things[5])
+            mirror = bool(int(things[8]))
+            c = cells[name]
+            currentCell.add(c, x, y, angle, mirror)
+        elif kind == "rect":
+            layer = int(things[4])
+            x1, y1 = map(int, COORD_RE.match(things[11]).groups())
+            x2, y2 = map(int, COORD_RE.match(things[12]).groups())
+            p = Rectangle(x1, y1, x2, y2, layer)
+            currentCell.add(p, 0, 0, 0, 0)
+            # the rectangle is already handling it's own offset, so we leave x=0, y=0
+        else: # kind == "poly"
+            layer = int(things[4])
+            numPoints = int(things[13])
+            end = m.end()
+            for i in range((numPoints + 3) // 4):
+                end = data.find(b"\n", end + 1)
+            if end < 0:
+                end = len(data) # the last line of the file had no newline
+            points = [ (int(x), int(y)) for x, y in COORD_RE.findall(data, m.end(), end) ]
+            p = Polygon(points, layer)
+            currentCell.add(p, 0, 0, 0, 0)
+            # the polygon is already handling it's own offset, so we leave x=0, y=0
+    return cells, currentCell
+
+data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+cells, currentCell = parse_dump(data)
 
 if len(sys.argv) == 4:
     # the user specified a cell to print out
-    cells[sys.argv[3]].print_me(0, 0, 0, 0)
+    topCell = cells[sys.argv[3]]
 else:
     # the last cell defined should be the top-level cell
-    currentCell.print_me(0, 0, 0, 0)
+    topCell = currentCell
+
+placements = flatten(topCell)
+jobs, numPolygons, numUses = make_jobs(placements[0], Counter(placements[0]))
+numWorkers = os.cpu_count() or 1
+# fork is only the safe default start method on Linux (macOS uses spawn)
+if len(jobs) > 1 and numWorkers > 1 and sys.platform.startswith("linux"):
+    # set just before forking, see make_jobs
+    worker_placements = placements
+    with ProcessPoolExecutor(max_workers=min(numWorkers, len(jobs)), mp_context=multiprocessing.get_context("fork")) as pool:
+        for texts in pool.map(print_job, jobs):
+            for layer, text in texts.items():
+                layer_buckets[layer].append(text)
+    worker_placements = None
+else:
+    # not worth starting workers, or we can't safely fork them on this system
+    for job in jobs:
+        for part in job:
+            print_placement(placements, *part)
+
+# all the geometry is in the buckets now, so we let go of the cell hierarchy
+# before writing, instead of holding on to both until the end
+cells.clear()
+del currentCell, topCell, jobs, placements
 
-# now that we have printed our polygons to the list, we write them to the file
-dump_to_write_to_file(output_file)
+# now that we have printed our polygons to the buckets, we write them to the file
+dump_layer_buckets_to_file(output_file)
 
-print("Finished writing " + str(len(to_write)) + " polygons to file.")
+print("Finished writing " + str(numPolygons) + " polygons and " + str(numUses) + " cell references to file.")
 if len(undefined_layers) > 0:
-    print("There were %d undefined layers: %s" % (len(undefined_layers), list(undefined_layers)))
+    print("WARNING!")
+    print("  This input file uses layers that are not defined!")
+    print("  The objects in these layers will be drawn as black boxes.")
+    print("  To fix this, simply add a new line to the source file for each new layer.")
+    print("  Please look in the source for the layer_colors definitions.")
+    print("There were %d undefined layers: %s" % (len(undefined_layers), sorted(undefined_layers)))
 
 make_svg_footer(output_file)
 output_file.close()
+data.close()
 input_file.close()